@@ -1,30 +1,175 @@
 import psycopg2
+import threading
 import numpy as np
-from typing import List, Dict, Optional
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Dict, Optional, Tuple
 from psycopg2.extras import execute_values
-from datetime import datetime
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+from psycopg2.extensions import TRANSACTION_STATUS_UNKNOWN
+from pgvector.psycopg2 import register_vector
+from datetime import date, datetime, time, timedelta
+
+# Hot-path statements are prepared once per pooled connection so repeated
+# calls skip the server-side parse and plan steps
+PREPARED_STATEMENTS = (
+    """
+    PREPARE stmt_has_event_today (text, text, timestamp, timestamp) AS
+        SELECT 1
+        FROM attendance
+        WHERE user_name = $1
+          AND event_type = $2
+          AND event_time >= $3
+          AND event_time < $4
+    """,
+    """
+    PREPARE stmt_log_attendance_once (text, text, float8, float8, timestamp, timestamp) AS
+        INSERT INTO attendance (user_name, event_type, latitude, longitude)
+        SELECT $1, $2, $3, $4
+        WHERE NOT EXISTS (
+            SELECT 1
+            FROM attendance
+            WHERE user_name = $1
+              AND event_type = $2
+              AND event_time >= $5
+              AND event_time < $6
+        )
+        RETURNING id
+    """,
+)
+
+class PooledConnection(psycopg2.extensions.connection):
+    # Set once the vector type is registered and PREPARED_STATEMENTS have run
+    ready = False
 
 class FaceEmbeddingDB:
-    def __init__(self, db_params: Dict[str, str]):
+    def __init__(self, db_params: Dict[str, str], minconn: int = 16, maxconn: int = 16, embedding_dim: int = 128,
+                 pool_timeout: float = 30.0):
         self.db_params = db_params
-        self.conn = None
+        self.embedding_dim = embedding_dim
+        # The pool closes returned connections beyond minconn, which would throw
+        # away their per-connection setup, so by default every one is kept open
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.pool = None
+        # ThreadedConnectionPool raises as soon as every connection is in use,
+        # so callers queue here for a free one instead
+        self._pool_slots = threading.BoundedSemaphore(maxconn)
+        self.pool_timeout = pool_timeout
+        # Bumped whenever face_embeddings changes so in-process caches can reload
+        self.embeddings_version = 0
+        # (user_name, event_type, day) for attendance events already logged today
+        self._attendance_cache = set()
+        self._attendance_cache_lock = threading.Lock()
         self.connect()
         self.create_tables()
 
     def connect(self):
         try:
-            self.conn = psycopg2.connect(**self.db_params)
+            self.pool = ThreadedConnectionPool(
+                self.minconn, self.maxconn, connection_factory=PooledConnection, **self.db_params
+            )
             print("Successfully connected to the database")
         except Exception as e:
             print(f"Error connecting to database: {e}")
             raise
 
+    @staticmethod
+    def _connection_lost(conn: PooledConnection) -> bool:
+        # Judged from the connection state rather than the exception class:
+        # OperationalError also covers cancelled queries, deadlocks and
+        # serialization failures on a perfectly healthy connection
+        return bool(conn.closed) or conn.get_transaction_status() == TRANSACTION_STATUS_UNKNOWN
+
+    @contextmanager
+    def _conn(self):
+        """Borrow a pooled connection, committing on success and rolling back on error."""
+        if not self._pool_slots.acquire(timeout=self.pool_timeout):
+            raise PoolError(f"no database connection free after {self.pool_timeout}s")
+        try:
+            conn = self.pool.getconn()
+        except BaseException:
+            self._pool_slots.release()
+            raise
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            if not self._connection_lost(conn):
+                conn.rollback()
+            raise
+        finally:
+            # Dead connections are closed rather than handed to the next caller
+            self.pool.putconn(conn, close=self._connection_lost(conn))
+            self._pool_slots.release()
+
+    def _exec(self, fn: Callable, *args, idempotent: bool = True, **kwargs):
+        """Run fn(cur, *args, **kwargs) in a pooled transaction, moving to another connection if this one is dead.
+
+        Work that is not idempotent is only retried if the connection died before
+        fn ran; afterwards the server may already have committed it.
+        """
+        # After a server restart every idle pooled connection is dead, so allow
+        # for working through all of them before a new one is opened
+        for attempt in range(self.maxconn + 1):
+            conn = None
+            started = False
+            try:
+                with self._conn() as conn:
+                    if not conn.ready:
+                        self._setup_connection(conn)
+                    with conn.cursor() as cur:
+                        started = True
+                        return fn(cur, *args, **kwargs)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                if (conn is None or not self._connection_lost(conn)
+                        or (started and not idempotent) or attempt == self.maxconn):
+                    raise
+                print(f"Database connection lost, retrying on another connection: {e}")
+
+    def _setup_connection(self, conn: PooledConnection):
+        # Pass numpy arrays straight through as vector parameters and read
+        # vector columns back as numpy arrays
+        register_vector(conn)
+        with conn.cursor() as cur:
+            for statement in PREPARED_STATEMENTS:
+                cur.execute(statement)
+        conn.commit()
+        conn.ready = True
+
+    def _day_bounds(self, day: date) -> Tuple[datetime, datetime]:
+        # A half-open timestamp range lets the (user_name, event_type, event_time)
+        # btree range-scan, where DATE(event_time) = day cannot use it
+        start = datetime.combine(day, time.min)
+        return start, start + timedelta(days=1)
+
+    def _attendance_cached(self, user_name: str, event_type: str, day: date) -> bool:
+        with self._attendance_cache_lock:
+            return (user_name, event_type, day) in self._attendance_cache
+
+    def _cache_attendance(self, user_name: str, event_type: str, day: date):
+        with self._attendance_cache_lock:
+            # Entries from previous days can never match again, drop them
+            self._attendance_cache = {key for key in self._attendance_cache if key[2] == day}
+            self._attendance_cache.add((user_name, event_type, day))
+
+    def _clear_attendance_cache(self, user_name: Optional[str] = None):
+        with self._attendance_cache_lock:
+            if user_name is None:
+                self._attendance_cache = set()
+            else:
+                self._attendance_cache = {key for key in self._attendance_cache if key[0] != user_name}
+
     def create_tables(self):
-        create_tables_query = """
+        create_tables_query = f"""
+        -- schema.sql only runs on a fresh data directory, so make sure the
+        -- extensions exist on databases created before they were added
+        CREATE EXTENSION IF NOT EXISTS vector;
+        CREATE EXTENSION IF NOT EXISTS postgis;
+
         CREATE TABLE IF NOT EXISTS face_embeddings (
             id SERIAL PRIMARY KEY,
             name VARCHAR(255) NOT NULL UNIQUE,
-            embedding vector(128) NOT NULL,
+            embedding vector({self.embedding_dim}) NOT NULL,
             created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
         );
 
@@ -37,255 +182,443 @@ class FaceEmbeddingDB:
             longitude FLOAT NOT NULL,
             FOREIGN KEY (user_name) REFERENCES face_embeddings (name) ON DELETE CASCADE
         );
+
+        CREATE TABLE IF NOT EXISTS geofences (
+            name VARCHAR(255) PRIMARY KEY,
+            geom GEOGRAPHY(Point, 4326) NOT NULL
+        );
+
+        CREATE INDEX IF NOT EXISTS attendance_user_type_time_idx
+            ON attendance (user_name, event_type, event_time DESC);
+
+        CREATE INDEX IF NOT EXISTS attendance_user_time_idx
+            ON attendance (user_name, event_time);
+
+        CREATE INDEX IF NOT EXISTS face_embeddings_hnsw
+            ON face_embeddings USING hnsw (embedding vector_cosine_ops);
+
+        CREATE INDEX IF NOT EXISTS geofences_geom_idx ON geofences USING GIST (geom);
         """
-        with self.conn.cursor() as cur:
+        # Connections are set up lazily by _exec, once the extension and tables exist
+        with self._conn() as conn, conn.cursor() as cur:
             cur.execute(create_tables_query)
-            self.conn.commit()
+            # CREATE TABLE IF NOT EXISTS keeps an existing column's size, e.g.
+            # after switching face models; pgvector stores it as the typmod
+            cur.execute("""
+                SELECT atttypmod
+                FROM pg_attribute
+                WHERE attrelid = 'face_embeddings'::regclass
+                  AND attname = 'embedding'
+            """)
+            stored_dim = cur.fetchone()[0]
+
+        if stored_dim != self.embedding_dim:
+            raise RuntimeError(
+                f"face_embeddings.embedding is vector({stored_dim}) but the face model produces "
+                f"{self.embedding_dim}-d embeddings; drop the face_embeddings and attendance tables and re-enroll users"
+            )
+
+    def sync_geofences(self, geofences: Dict[str, Tuple[float, float]]) -> bool:
+        def run(cur):
+            execute_values(cur, """
+                INSERT INTO geofences (name, geom)
+                VALUES %s
+                ON CONFLICT (name) DO UPDATE
+                SET geom = EXCLUDED.geom
+            """, [
+                (name, lon, lat)
+                for name, (lat, lon) in geofences.items()
+            ], template="(%s, ST_SetSRID(ST_MakePoint(%s, %s), 4326)::geography)")
+            # Fences removed from the config must stop allowing check-ins
+            cur.execute("DELETE FROM geofences WHERE name <> ALL(%s)", (list(geofences),))
+
+        try:
+            self._exec(run)
+            return True
+        except Exception as e:
+            print(f"Error syncing geofences: {e}")
+            return False
+
+    def is_within_any_geofence(self, latitude: float, longitude: float, max_distance: float) -> bool:
+        def run(cur):
+            cur.execute("""
+                SELECT EXISTS (
+                    SELECT 1
+                    FROM geofences
+                    WHERE ST_DWithin(geom, ST_SetSRID(ST_MakePoint(%s, %s), 4326)::geography, %s)
+                )
+            """, (longitude, latitude, max_distance))
+            return cur.fetchone()[0]
+
+        try:
+            return self._exec(run)
+        except Exception as e:
+            print(f"Error checking geofences: {e}")
+            return False
 
     def store_embedding(self, name: str, embedding: np.ndarray) -> bool:
+        def run(cur):
+            cur.execute("""
+                INSERT INTO face_embeddings (name, embedding)
+                VALUES (%s, %s)
+                ON CONFLICT (name) DO UPDATE
+                SET embedding = EXCLUDED.embedding
+            """, (name, embedding))
+
         try:
-            with self.conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO face_embeddings (name, embedding)
-                    VALUES (%s, %s)
-                    ON CONFLICT (name) DO UPDATE
-                    SET embedding = EXCLUDED.embedding
-                """, (name, embedding.tolist()))
-                self.conn.commit()
-                return True
+            self._exec(run)
+            self.embeddings_version += 1
+            return True
         except Exception as e:
             print(f"Error storing embedding: {e}")
-            self.conn.rollback()
             return False
 
+    def store_if_unique(self, name: str, embedding: np.ndarray, threshold: float = 0.1) -> Tuple[Optional[int], Optional[str]]:
+        # Returns (id, None) for a new user, or (None, "name") / (None, "face") when
+        # the name or a face within the cosine distance threshold is already enrolled.
+        # Database errors are raised so callers can tell them apart from duplicates.
+        def run(cur):
+            # NOT EXISTS takes no lock under READ COMMITTED, so concurrent enrollments
+            # queue on a transaction-level advisory lock before checking
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext('face_embeddings_enroll'))")
+            # An identical row under this name is our own insert, committed just
+            # before the connection dropped, which makes a retry harmless
+            cur.execute(
+                "SELECT id, embedding = %s::vector FROM face_embeddings WHERE name = %s",
+                (embedding, name)
+            )
+            existing = cur.fetchone()
+            if existing is not None:
+                return (existing[0], None) if existing[1] else (None, "name")
+
+            cur.execute("""
+                INSERT INTO face_embeddings (name, embedding)
+                SELECT %(name)s, %(embedding)s::vector
+                WHERE NOT EXISTS (
+                    SELECT 1
+                    FROM face_embeddings
+                    WHERE embedding <=> %(embedding)s::vector < %(threshold)s
+                )
+                ON CONFLICT (name) DO NOTHING
+                RETURNING id
+            """, {"name": name, "embedding": embedding, "threshold": threshold})
+            row = cur.fetchone()
+            return (row[0], None) if row is not None else (None, "face")
+
+        user_id, conflict = self._exec(run)
+        if user_id is not None:
+            self.embeddings_version += 1
+        return user_id, conflict
+
     def store_multiple_embeddings(self, embeddings_data: List[Dict[str, any]]) -> bool:
+        def run(cur):
+            embeddings_values = [
+                (data['name'], data['embedding'])
+                for data in embeddings_data
+            ]
+            execute_values(cur, """
+                INSERT INTO face_embeddings (name, embedding)
+                VALUES %s
+                ON CONFLICT (name) DO UPDATE
+                SET embedding = EXCLUDED.embedding
+            """, embeddings_values)
+
         try:
-            with self.conn.cursor() as cur:
-                embeddings_values = [
-                    (data['name'], data['embedding'].tolist())
-                    for data in embeddings_data
-                ]
-                execute_values(cur, """
-                    INSERT INTO face_embeddings (name, embedding)
-                    VALUES %s
-                    ON CONFLICT (name) DO UPDATE
-                    SET embedding = EXCLUDED.embedding
-                """, embeddings_values)
-                self.conn.commit()
-                return True
+            self._exec(run)
+            self.embeddings_version += 1
+            return True
         except Exception as e:
             print(f"Error storing multiple embeddings: {e}")
-            self.conn.rollback()
             return False
 
-    def retrieve_all_data(self) -> List[Dict[str, any]]:
-        try:
-            with self.conn.cursor() as cur:
-                query = """
+    def retrieve_all_data(self, batch_size: int = 500) -> Iterator[Dict[str, any]]:
+        # Rows are fetched in id-ordered pages, each in its own short transaction,
+        # so a slow client download never holds a pooled connection between pages
+        def run(cur, last_id):
+            cur.execute("""
+                SELECT
+                    fe.id,
+                    fe.name,
+                    fe.embedding::text,
+                    fe.created_at,
+                    a.latest_checkin,
+                    a.latest_checkout
+                FROM face_embeddings fe
+                LEFT JOIN LATERAL (
                     SELECT
-                        fe.id,
-                        fe.name,
-                        fe.embedding,
-                        fe.created_at,
-                        (
-                            SELECT event_time
-                            FROM attendance
-                            WHERE user_name = fe.name AND event_type = 'checkin'
-                            ORDER BY event_time DESC
-                            LIMIT 1
-                        ) AS latest_checkin,
-                        (
-                            SELECT event_time
-                            FROM attendance
-                            WHERE user_name = fe.name AND event_type = 'checkout'
-                            ORDER BY event_time DESC
-                            LIMIT 1
-                        ) AS latest_checkout
-                    FROM face_embeddings fe;
-                """
-                cur.execute(query)
-                results = cur.fetchall()
-                return [
-                    {
-                        "id": row[0],
-                        "name": row[1],
-                        "embedding": row[2],
-                        "created_at": row[3],
-                        "latest_checkin": row[4],
-                        "latest_checkout": row[5]
-                    }
-                    for row in results
-                ]
-        except Exception as e:
-            print(f"Error retrieving data with check-in/check-out: {e}")
-            return []
+                        MAX(event_time) FILTER (WHERE event_type = 'checkin') AS latest_checkin,
+                        MAX(event_time) FILTER (WHERE event_type = 'checkout') AS latest_checkout
+                    FROM attendance
+                    WHERE user_name = fe.name
+                ) a ON TRUE
+                WHERE fe.id > %s
+                ORDER BY fe.id
+                LIMIT %s
+            """, (last_id, batch_size))
+            return cur.fetchall()
+
+        last_id = 0
+        while True:
+            try:
+                rows = self._exec(run, last_id)
+            except Exception as e:
+                # Re-raised so a streaming response is aborted instead of ending
+                # early with a truncated body that looks complete
+                print(f"Error retrieving data with check-in/check-out: {e}")
+                raise
+
+            for row in rows:
+                yield {
+                    "id": row[0],
+                    "name": row[1],
+                    "embedding": row[2],
+                    "created_at": row[3],
+                    "latest_checkin": row[4],
+                    "latest_checkout": row[5]
+                }
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1][0]
 
     def has_checked_in_today(self, user_name: str) -> bool:
         today = datetime.now().date()
+        if self._attendance_cached(user_name, 'checkin', today):
+            return True
+
+        def run(cur):
+            cur.execute(
+                "EXECUTE stmt_has_event_today (%s, %s, %s, %s)",
+                (user_name, 'checkin', *self._day_bounds(today))
+            )
+            return cur.fetchone() is not None
+
         try:
-            with self.conn.cursor() as cur:
-                cur.execute("""
-                    SELECT 1
-                    FROM attendance
-                    WHERE user_name = %s
-                      AND event_type = 'checkin'
-                      AND DATE(event_time) = %s
-                """, (user_name, today))
-                return cur.fetchone() is not None
+            checked = self._exec(run)
+            if checked:
+                self._cache_attendance(user_name, 'checkin', today)
+            return checked
         except Exception as e:
             print(f"Error checking if user has checked in today: {e}")
             return False
 
     def has_checked_out_today(self, user_name: str) -> bool:
         today = datetime.now().date()
+        if self._attendance_cached(user_name, 'checkout', today):
+            return True
+
+        def run(cur):
+            cur.execute(
+                "EXECUTE stmt_has_event_today (%s, %s, %s, %s)",
+                (user_name, 'checkout', *self._day_bounds(today))
+            )
+            return cur.fetchone() is not None
+
         try:
-            with self.conn.cursor() as cur:
-                cur.execute("""
-                    SELECT 1
-                    FROM attendance
-                    WHERE user_name = %s
-                      AND event_type = 'checkout'
-                      AND DATE(event_time) = %s
-                """, (user_name, today))
-                return cur.fetchone() is not None
+            checked = self._exec(run)
+            if checked:
+                self._cache_attendance(user_name, 'checkout', today)
+            return checked
         except Exception as e:
             print(f"Error checking if user has checked out today: {e}")
             return False
 
     def delete_tables(self):
         delete_tables_query = "DROP TABLE IF EXISTS face_embeddings, attendance CASCADE;"
+
+        def run(cur):
+            cur.execute(delete_tables_query)
+
         try:
-            with self.conn.cursor() as cur:
-                cur.execute(delete_tables_query)
-                self.conn.commit()
-                print("Successfully deleted the tables")
+            self._exec(run)
+            self.embeddings_version += 1
+            self._clear_attendance_cache()
+            print("Successfully deleted the tables")
         except Exception as e:
             print(f"Error deleting tables: {e}")
-            self.conn.rollback()
 
     def get_user_attendance_report(self, user_name: str) -> List[Dict[str, any]]:
-        try:
-            with self.conn.cursor() as cur:
-                query = """
-                    WITH daily_attendance AS (
-                        SELECT
-                            DATE(event_time) as attendance_date,
-                            MAX(CASE WHEN event_type = 'checkin' THEN event_time END) as checkin_time,
-                            MAX(CASE WHEN event_type = 'checkout' THEN event_time END) as checkout_time
-                        FROM attendance
-                        WHERE user_name = %s
-                        GROUP BY DATE(event_time)
-                    )
+        def run(cur):
+            query = """
+                WITH daily_attendance AS (
                     SELECT
-                        attendance_date,
-                        checkin_time,
-                        checkout_time
-                    FROM daily_attendance
-                    ORDER BY attendance_date DESC;
-                """
-                cur.execute(query, (user_name,))
-                results = cur.fetchall()
-
-                return [
-                    {
-                        "date": row[0],
-                        "checkin_time": row[1],
-                        "checkout_time": row[2]
-                    }
-                    for row in results
-                ]
+                        DATE(event_time) as attendance_date,
+                        MAX(CASE WHEN event_type = 'checkin' THEN event_time END) as checkin_time,
+                        MAX(CASE WHEN event_type = 'checkout' THEN event_time END) as checkout_time
+                    FROM attendance
+                    WHERE user_name = %s
+                    GROUP BY DATE(event_time)
+                )
+                SELECT
+                    attendance_date,
+                    checkin_time,
+                    checkout_time
+                FROM daily_attendance
+                ORDER BY attendance_date DESC;
+            """
+            cur.execute(query, (user_name,))
+            results = cur.fetchall()
+
+            return [
+                {
+                    "date": row[0],
+                    "checkin_time": row[1],
+                    "checkout_time": row[2]
+                }
+                for row in results
+            ]
+
+        try:
+            return self._exec(run)
         except Exception as e:
             print(f"Error retrieving user attendance report: {e}")
             return []
 
     def embedding_exists(self, embedding: np.ndarray) -> bool:
+        def run(cur):
+            cur.execute("""
+                SELECT 1
+                FROM face_embeddings
+                WHERE embedding = %s
+            """, (embedding,))
+            return cur.fetchone() is not None
+
         try:
-            with self.conn.cursor() as cur:
-                cur.execute("""
-                    SELECT 1
-                    FROM face_embeddings
-                    WHERE embedding = %s
-                """, (embedding.tolist(),))
-                return cur.fetchone() is not None
+            return self._exec(run)
         except Exception as e:
             print(f"Error checking if embedding exists: {e}")
             return False
 
     def delete_user(self, name: str) -> bool:
+        def run(cur):
+            cur.execute("DELETE FROM face_embeddings WHERE name = %s", (name,))
+            return cur.rowcount > 0
+
         try:
-            with self.conn.cursor() as cur:
-                cur.execute("DELETE FROM face_embeddings WHERE name = %s", (name,))
-                self.conn.commit()
-                if cur.rowcount > 0:
-                    print(f"User '{name}' deleted successfully.")
-                    return True
-                else:
-                    print(f"User '{name}' not found.")
-                    return False
+            # Not retried: a repeat after a lost commit would report "not found"
+            deleted = self._exec(run, idempotent=False)
+            if deleted:
+                self.embeddings_version += 1
+                self._clear_attendance_cache(name)
+                print(f"User '{name}' deleted successfully.")
+                return True
+            else:
+                print(f"User '{name}' not found.")
+                return False
         except Exception as e:
             print(f"Error deleting user '{name}': {e}")
-            self.conn.rollback()
             return False
 
-    def vector_search(self, encoding: np.ndarray) -> List[Dict[str, any]]:
+    def vector_search(self, encoding: np.ndarray, max_distance: float = 0.1,
+                      ef_search: int = 40) -> List[Dict[str, any]]:
+        def run(cur):
+            # HNSW candidate list size for this transaction only
+            cur.execute("SET LOCAL hnsw.ef_search = %s", (ef_search,))
+            # Ordering by the bare distance to the bound vector lets the
+            # HNSW index serve the ordered scan
+            cur.execute("""
+                SELECT id, name, embedding, created_at,
+                1 - (embedding <=> %(encoding)s::vector) as similarity
+                FROM face_embeddings
+                WHERE embedding <=> %(encoding)s::vector < %(max_distance)s
+                ORDER BY embedding <=> %(encoding)s::vector
+                LIMIT 5
+            """, {"encoding": encoding, "max_distance": max_distance})
+            results = cur.fetchall()
+            return [
+                {
+                    "id": result[0],
+                    "name": result[1],
+                    "embedding": result[2],
+                    "created_at": result[3],
+                    "similarity": result[4]
+                }
+                for result in results
+            ]
+
         try:
-            with self.conn.cursor() as cur:
-                query = """
-                    SELECT id, name, embedding, created_at,
-                    1 - (embedding <=> %s::vector) as similarity
-                    FROM face_embeddings
-                    WHERE 1 - (embedding <=> %s::vector) > %s
-                    ORDER BY embedding <=> %s::vector
-                    LIMIT 5;
-                """
-                cur.execute(query, (encoding.tolist(), encoding.tolist(), 0.9, encoding.tolist()))
-                results = cur.fetchall()
-                return [
-                    {
-                        "id": result[0],
-                        "name": result[1],
-                        "embedding": result[2],
-                        "created_at": result[3],
-                        "similarity": result[4]
-                    }
-                    for result in results
-                ]
+            return self._exec(run)
         except Exception as e:
             print(f"Error performing vector search: {e}")
             return []
 
+    def load_all_embeddings(self) -> Optional[Tuple[List[str], np.ndarray]]:
+        def run(cur):
+            cur.execute("""
+                SELECT name, embedding
+                FROM face_embeddings
+                ORDER BY id
+            """)
+            results = cur.fetchall()
+            names = [row[0] for row in results]
+            # An explicit width keeps an empty table reshapeable, -1 can't be inferred from 0 rows
+            matrix = np.array([row[1] for row in results], dtype=np.float32).reshape(len(results), self.embedding_dim)
+            return names, matrix
+
+        try:
+            return self._exec(run)
+        except Exception as e:
+            print(f"Error loading embeddings: {e}")
+            return None
+
     def log_attendance(self, user_name: str, event_type: str, latitude: float, longitude: float) -> bool:
+        def run(cur):
+            cur.execute("""
+                INSERT INTO attendance (user_name, event_type, latitude, longitude)
+                VALUES (%s, %s, %s, %s)
+            """, (user_name, event_type, latitude, longitude))
+
         try:
-            with self.conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO attendance (user_name, event_type, latitude, longitude)
-                    VALUES (%s, %s, %s, %s)
-                """, (user_name, event_type, latitude, longitude))
-                self.conn.commit()
-                return True
+            # Not retried: a repeat after a lost commit would log the event twice
+            self._exec(run, idempotent=False)
+            self._cache_attendance(user_name, event_type, datetime.now().date())
+            return True
         except Exception as e:
             print(f"Error logging attendance: {e}")
-            self.conn.rollback()
             return False
 
+    def log_attendance_once(self, user_name: str, event_type: str, latitude: float, longitude: float) -> Optional[bool]:
+        """Log the event unless the user already has one today: True if logged, False if not, None on error."""
+        today = datetime.now().date()
+
+        def run(cur):
+            # NOT EXISTS alone takes no lock, so concurrent requests for the same
+            # user and event queue on an advisory lock held until commit
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (f"attendance:{user_name}:{event_type}",))
+            cur.execute(
+                "EXECUTE stmt_log_attendance_once (%s, %s, %s, %s, %s, %s)",
+                (user_name, event_type, latitude, longitude, *self._day_bounds(today))
+            )
+            return cur.fetchone() is not None
+
+        try:
+            # Safe to retry: a repeat after a lost commit finds the row and logs nothing
+            logged = self._exec(run)
+            self._cache_attendance(user_name, event_type, today)
+            return logged
+        except Exception as e:
+            print(f"Error logging attendance: {e}")
+            return None
+
     def retrieve_attendance(self, user_name: str) -> List[Dict[str, any]]:
+        def run(cur):
+            cur.execute("""
+                SELECT event_type, event_time
+                FROM attendance
+                WHERE user_name = %s
+                ORDER BY event_time DESC
+            """, (user_name,))
+            attendance_records = cur.fetchall()
+            return [
+                {"event_type": row[0], "event_time": row[1]}
+                for row in attendance_records
+            ]
+
         try:
-            with self.conn.cursor() as cur:
-                cur.execute("""
-                    SELECT event_type, event_time
-                    FROM attendance
-                    WHERE user_name = %s
-                    ORDER BY event_time DESC
-                """, (user_name,))
-                attendance_records = cur.fetchall()
-                return [
-                    {"event_type": row[0], "event_time": row[1]}
-                    for row in attendance_records
-                ]
+            return self._exec(run)
         except Exception as e:
             print(f"Error retrieving attendance: {e}")
             return []
 
     def close(self):
-        if self.conn:
-            self.conn.close()
+        if self.pool:
+            self.pool.closeall()
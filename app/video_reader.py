@@ -0,0 +1,124 @@
+import cv2
+import numpy as np
+from typing import Iterator, Optional, Tuple
+
+# Optional GPU decoders, OpenCV is used when neither is installed
+try:
+    from torchcodec.decoders import VideoDecoder
+except ImportError:
+    VideoDecoder = None
+
+try:
+    import ffmpegcv
+except ImportError:
+    ffmpegcv = None
+
+class VideoFrameSampler:
+    def __init__(self, video_path: str, stride: int = 5, batch_size: int = 32):
+        self.video_path = video_path
+        self.stride = stride
+        self.batch_size = batch_size
+        self.total_frames = 0
+        self._decoder = None
+        self._capture = None
+        self.backend = self._open()
+
+    def _open(self) -> str:
+        """Open the video with NVDEC if possible, falling back to CPU decoding."""
+        if VideoDecoder is not None:
+            try:
+                decoder = VideoDecoder(self.video_path, device="cuda", seek_mode="approximate")
+                # Approximate mode reads the frame count from the container header,
+                # which may not have one; the indices can't be planned without it
+                if decoder.metadata.num_frames is None:
+                    raise ValueError("container does not report a frame count")
+                self._decoder = decoder
+                self.total_frames = decoder.metadata.num_frames
+                return "torchcodec"
+            except Exception as e:
+                print(f"torchcodec CUDA decoding unavailable: {e}")
+
+        if ffmpegcv is not None:
+            try:
+                self._capture = ffmpegcv.VideoCaptureNV(self.video_path)
+                return "ffmpegcv"
+            except Exception as e:
+                print(f"ffmpegcv NVDEC decoding unavailable: {e}")
+
+        self._capture = cv2.VideoCapture(self.video_path)
+        return "opencv"
+
+    def __iter__(self) -> Iterator[Tuple[int, np.ndarray]]:
+        """Yield (frame index, BGR frame) for every sampled frame."""
+        if self._decoder is not None:
+            yield from self._iter_decoder()
+        else:
+            yield from self._iter_capture()
+
+    def _iter_decoder(self) -> Iterator[Tuple[int, np.ndarray]]:
+        # Only the requested frames are decoded, in batches to bound GPU memory
+        indices = list(range(0, self.total_frames, self.stride))
+        for start in range(0, len(indices), self.batch_size):
+            batch_indices = indices[start:start + self.batch_size]
+            frames = self._decoder.get_frames_at(indices=batch_indices).data
+            # NCHW RGB on the GPU -> NHWC BGR on the host, as OpenCV would return
+            frames = frames.permute(0, 2, 3, 1).flip(-1).contiguous().cpu().numpy()
+            for frame_index, frame in zip(batch_indices, frames):
+                yield frame_index, frame
+
+    def _iter_capture(self) -> Iterator[Tuple[int, np.ndarray]]:
+        if self.backend == "opencv":
+            read_frame = self._read_opencv
+        else:
+            read_frame = self._read_all
+        frame_count = 0
+        try:
+            while True:
+                ret, frame = read_frame(frame_count % self.stride == 0)
+                if not ret:
+                    break
+
+                if frame is not None:
+                    yield frame_count, frame
+
+                frame_count += 1
+                self.total_frames = frame_count
+        finally:
+            self._capture.release()
+
+    def _read_opencv(self, sampled: bool) -> Tuple[bool, Optional[np.ndarray]]:
+        # grab() advances past skipped frames without the BGR conversion
+        # and copy that retrieve() does for the frames we keep
+        if not self._capture.grab():
+            return False, None
+        if not sampled:
+            return True, None
+        return self._capture.retrieve()
+
+    def _read_all(self, sampled: bool) -> Tuple[bool, Optional[np.ndarray]]:
+        ret, frame = self._capture.read()
+        return ret, frame if sampled else None
+
+class MotionGate:
+    def __init__(self, threshold: float = 5.0, max_gap: int = 30, size: Tuple[int, int] = (80, 45)):
+        self.threshold = threshold
+        self.max_gap = max_gap
+        self.size = size
+        self._last_small = None
+        self._last_index = None
+
+    def __call__(self, frame_index: int, frame: np.ndarray) -> bool:
+        """Return True if the frame should go through face detection."""
+        # Tiny grayscale thumbnails keep the diff far cheaper than detection
+        small = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), self.size, interpolation=cv2.INTER_AREA)
+
+        # Compare against the last frame that was let through, so slow motion
+        # still adds up to a detection instead of staying under the threshold
+        if (self._last_small is not None
+                and frame_index - self._last_index <= self.max_gap
+                and cv2.absdiff(self._last_small, small).mean() <= self.threshold):
+            return False
+
+        self._last_small = small
+        self._last_index = frame_index
+        return True
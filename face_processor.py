@@ -1,19 +1,73 @@
 import face_recognition
 import os
+import threading
 import numpy as np
 import cv2
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 from datetime import datetime, timedelta
 from .face_vector import FaceEmbeddingDB
 
+# Optional GPU face model, only needed when FaceProcessor runs with model="arcface"
+try:
+    from insightface.app import FaceAnalysis
+    from insightface.utils import face_align
+except ImportError:
+    FaceAnalysis = None
+
+# Embedding size produced by each face model
+EMBEDDING_DIMS = {"dlib": 128, "arcface": 512}
+
+# Built TensorRT engines are kept here so restarts (and --reload) don't rebuild them
+TRT_ENGINE_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".insightface", "trt_engines")
+
+# Per model: (cosine similarity a stored face needs to be a candidate, confidence needed to report a match)
+MODEL_THRESHOLDS = {"dlib": (0.9, 0.7), "arcface": (0.5, 0.5)}
+
 class FaceProcessor:
-    def __init__(self, employee_images_path: str, db_handler: FaceEmbeddingDB):
+    def __init__(self, employee_images_path: str, db_handler: FaceEmbeddingDB, model: str = "dlib"):
         self.employee_images_path = employee_images_path
         self.db_handler = db_handler
+        self.model = model
+        self.embedding_dim = EMBEDDING_DIMS[model]
+        self.similarity_threshold, self.min_confidence = MODEL_THRESHOLDS[model]
+        self._arcface = self._load_arcface() if model == "arcface" else None
         self.last_reload_time = None
         self.reload_interval = timedelta(minutes=10)
+        # Face models are shared, so requests coming from worker threads take turns
+        self._model_lock = threading.Lock()
+        # Only one worker thread re-scans the employee images when the interval is up
+        self._reload_lock = threading.Lock()
+        # In-process copy of the stored embeddings: (names, raw matrix, unit-normalized matrix)
+        self._embedding_cache = (
+            [],
+            np.empty((0, self.embedding_dim), dtype=np.float32),
+            np.empty((0, self.embedding_dim), dtype=np.float32)
+        )
+        self._embedding_cache_version = None
         self.process_employee_images()
 
+    def _load_arcface(self):
+        """Load RetinaFace + ArcFace r50 on TensorRT/CUDA and warm it up once."""
+        if FaceAnalysis is None:
+            raise RuntimeError("insightface is required for the arcface face model")
+
+        tensorrt_options = {
+            "trt_fp16_enable": True,
+            "trt_engine_cache_enable": True,
+            "trt_engine_cache_path": TRT_ENGINE_CACHE_PATH,
+        }
+        app = FaceAnalysis(
+            name="buffalo_l",
+            allowed_modules=["detection", "recognition"],
+            providers=[("TensorrtExecutionProvider", tensorrt_options), "CUDAExecutionProvider", "CPUExecutionProvider"]
+        )
+        app.prepare(ctx_id=0, det_size=(640, 640))
+        # The first run builds the TensorRT engines, don't make a request pay for it.
+        # A blank image has no faces, so the recognition model is warmed up on its own.
+        app.get(np.zeros((640, 640, 3), dtype=np.uint8))
+        app.models["recognition"].get_feat([np.zeros((112, 112, 3), dtype=np.uint8)])
+        return app
+
     def should_reload(self) -> bool:
         """Check if we should reload the encodings based on time interval."""
         if self.last_reload_time is None:
@@ -33,6 +87,8 @@ class FaceProcessor:
                         self._process_employee_image(image_path, employee_name)
         
         self.last_reload_time = datetime.now()
+        # Also pick up embeddings written by other workers
+        self._embedding_cache_version = None
         print(f"Finished processing employee images")
 
     def _process_employee_image(self, image_path: str, employee_name: str):
@@ -43,82 +99,203 @@ class FaceProcessor:
                 print(f"Embedding for {employee_name} already exists in the database.")
                 return None
             
-            image = face_recognition.load_image_file(image_path)
-            face_encodings = face_recognition.face_encodings(image)
-            
-            if face_encodings:
-                encoding = face_encodings[0]
+            encoding = self.encode_image(image_path)
+            if encoding is not None:
                 self.db_handler.store_embedding(employee_name, encoding)
-                return encoding
-            return None
+            return encoding
         except Exception as e:
             print(f"Error processing image {image_path}: {str(e)}")
             return None
 
+    def encode_image(self, image_path: str) -> Optional[np.ndarray]:
+        """Return the encoding of the first face in an image without storing it."""
+        try:
+            if self._arcface is not None:
+                _, batch_face_encodings = self._detect_arcface([cv2.imread(image_path)])
+                face_encodings = batch_face_encodings[0]
+            else:
+                image = face_recognition.load_image_file(image_path)
+                with self._model_lock:
+                    face_encodings = face_recognition.face_encodings(image)
+            return face_encodings[0] if face_encodings else None
+        except Exception as e:
+            print(f"Error encoding image {image_path}: {str(e)}")
+            return None
+
     def process_video_frame(self, frame_numpy: np.ndarray) -> List[Dict]:
         """Process a single video frame and return detected faces with enhanced matching logic."""
-        # Check if we need to reload employee images
+        return self.process_video_frames_batched([frame_numpy])[0]
+
+    def process_video_frames_batched(self, frames: List[np.ndarray], batch_size: int = 32) -> List[List[Dict]]:
+        """Process same-sized frames with one batched detection pass and one vector lookup."""
+        # Check if we need to reload employee images; threads that waited on the
+        # lock check again so the images are only scanned once per interval
         if self.should_reload():
-            self.process_employee_images()
-            
-        # Reduce frame size minimally for better accuracy
-        small_frame = cv2.resize(frame_numpy, (0, 0), fx=0.35, fy=0.35)
-        
-        # Convert from BGR to RGB
-        rgb_small_frame = cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB)
-        
-        # Find faces in the frame
-        face_locations = face_recognition.face_locations(rgb_small_frame, model="cnn")
-        face_encodings = face_recognition.face_encodings(rgb_small_frame, face_locations)
-        
-        detected_faces = []
-        
-        for face_encoding, face_location in zip(face_encodings, face_locations):
-            # Get top 5 closest matches from vector search
-            results = self.db_handler.vector_search(face_encoding)
-            
-            name = "Unknown"
-            confidence = 0.0
-            
-            if results:
-                try:
-                    candidate_encodings = []
-                    for result in results:
-                        embedding_str = result["embedding"].strip('[]')
-                        embedding_values = [float(x.strip()) for x in embedding_str.split(',')]
-                        candidate_encodings.append(np.array(embedding_values))
-                    
-                    candidate_names = [result["name"] for result in results]
-                    
-                    # Compare with candidate faces using face_recognition
-                    matches = face_recognition.compare_faces(candidate_encodings, face_encoding, tolerance=0.6)
-                    face_distances = face_recognition.face_distance(candidate_encodings, face_encoding)
-                    
-                    if len(face_distances) > 0:
-                        best_match_index = np.argmin(face_distances)
-                        if matches[best_match_index]:
-                            name = candidate_names[best_match_index]
-                            confidence = 1 - face_distances[best_match_index]
-                            # Also consider the vector similarity as a factor
-                            vector_confidence = results[best_match_index]["similarity"]
-                            # Take the average of both confidence measures
-                            confidence = (confidence + vector_confidence) / 2
-                except Exception as e:
-                    print(f"Error processing embeddings: {e}")
+            with self._reload_lock:
+                if self.should_reload():
+                    self.process_employee_images()
+
+        if self._arcface is not None:
+            batch_face_locations, batch_face_encodings = self._detect_arcface(frames)
+            location_scale = 1
+        else:
+            batch_face_locations, batch_face_encodings = self._detect_dlib(frames, batch_size)
+            location_scale = 4
+
+        # Get top 5 closest matches for every face in the batch from the in-process cache
+        all_encodings = [encoding for face_encodings in batch_face_encodings for encoding in face_encodings]
+        all_results = iter(self._search_embeddings(all_encodings, threshold=self.similarity_threshold))
+
+        batch_detected_faces = []
+        for face_encodings, face_locations in zip(batch_face_encodings, batch_face_locations):
+            detected_faces = []
+
+            for face_encoding, face_location in zip(face_encodings, face_locations):
+                match = self._match_face(face_encoding, next(all_results))
+                if match is None:
                     continue
-            
-            # Only include if confidence is high enough
-            if name == "Unknown" or confidence > 0.7:
-                top, right, bottom, left = face_location
-                detected_faces.append({
-                    "name": name,
-                    "confidence": float(confidence),
-                    "location": {
-                        "top": top * 4,
-                        "right": right * 4,
-                        "bottom": bottom * 4,
-                        "left": left * 4
-                    }
-                })
-        
-        return detected_faces
\ No newline at end of file
+                name, confidence = match
+
+                # Only include if confidence is high enough
+                if name == "Unknown" or confidence > self.min_confidence:
+                    top, right, bottom, left = face_location
+                    detected_faces.append({
+                        "name": name,
+                        "confidence": float(confidence),
+                        "location": {
+                            "top": top * location_scale,
+                            "right": right * location_scale,
+                            "bottom": bottom * location_scale,
+                            "left": left * location_scale
+                        }
+                    })
+
+            batch_detected_faces.append(detected_faces)
+
+        return batch_detected_faces
+
+    def _detect_dlib(self, frames: List[np.ndarray], batch_size: int) -> Tuple[List[List[Tuple]], List[List[np.ndarray]]]:
+        """Locate and encode faces with dlib, returning per-frame locations and encodings."""
+        # Reduce frame size minimally for better accuracy and convert from BGR to RGB
+        rgb_small_frames = [
+            cv2.cvtColor(cv2.resize(frame, (0, 0), fx=0.35, fy=0.35), cv2.COLOR_BGR2RGB)
+            for frame in frames
+        ]
+
+        # Find faces in all frames at once, the CNN detector runs them as one batch
+        with self._model_lock:
+            batch_face_locations = face_recognition.batch_face_locations(rgb_small_frames, batch_size=batch_size)
+            batch_face_encodings = [
+                face_recognition.face_encodings(rgb_small_frame, face_locations)
+                for rgb_small_frame, face_locations in zip(rgb_small_frames, batch_face_locations)
+            ]
+        return batch_face_locations, batch_face_encodings
+
+    def _detect_arcface(self, frames: List[np.ndarray]) -> Tuple[List[List[Tuple]], List[List[np.ndarray]]]:
+        """Locate faces with RetinaFace and embed every aligned face in one ArcFace batch."""
+        batch_face_locations = [[] for _ in frames]
+        batch_face_encodings = [[] for _ in frames]
+        crops = []
+        owners = []
+
+        with self._model_lock:
+            for frame_index, frame in enumerate(frames):
+                bboxes, kpss = self._arcface.det_model.detect(frame, max_num=0, metric="default")
+                for bbox, kps in zip(bboxes, kpss):
+                    crops.append(face_align.norm_crop(frame, landmark=kps, image_size=112))
+                    owners.append(frame_index)
+                    # Plain ints, numpy.int64 can't be JSON-encoded in the response
+                    left, top, right, bottom = (int(v) for v in bbox[:4])
+                    batch_face_locations[frame_index].append((top, right, bottom, left))
+
+            if crops:
+                # (N, 3, 112, 112) forward pass for all faces in the batch
+                embeddings = self._arcface.models["recognition"].get_feat(crops)
+                embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+                for frame_index, embedding in zip(owners, embeddings):
+                    batch_face_encodings[frame_index].append(embedding)
+
+        return batch_face_locations, batch_face_encodings
+
+    def _refresh_embedding_cache(self):
+        """Reload the cached embeddings if the database has changed since the last load."""
+        version = self.db_handler.embeddings_version
+        if version == self._embedding_cache_version:
+            return
+
+        loaded = self.db_handler.load_all_embeddings()
+        if loaded is None:
+            # The cached rows are known to be out of date (e.g. a user was just
+            # deleted), so match against nothing until a reload succeeds
+            self._embedding_cache = (
+                [],
+                np.empty((0, self.embedding_dim), dtype=np.float32),
+                np.empty((0, self.embedding_dim), dtype=np.float32)
+            )
+            return
+
+        names, matrix = loaded
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        normalized = matrix / np.maximum(norms, 1e-12)
+        self._embedding_cache = (names, matrix, normalized)
+        self._embedding_cache_version = version
+
+    def _search_embeddings(self, encodings: List[np.ndarray], limit: int = 5, threshold: float = 0.9) -> List[List[Dict]]:
+        """Return the closest cached embeddings above the cosine threshold for each encoding."""
+        self._refresh_embedding_cache()
+        names, matrix, normalized = self._embedding_cache
+        if not encodings or not names:
+            return [[] for _ in encodings]
+
+        queries = np.asarray(encodings, dtype=np.float32)
+        queries /= np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        # float32 GEMM goes through BLAS; numpy has no int8 kernel to beat it
+        similarities = queries @ normalized.T
+
+        k = min(limit, len(names))
+        all_results = []
+        for row in similarities:
+            top = np.argpartition(-row, k - 1)[:k]
+            top = top[np.argsort(-row[top])]
+            all_results.append([
+                {"name": names[i], "embedding": matrix[i], "similarity": float(row[i])}
+                for i in top
+                if row[i] > threshold
+            ])
+        return all_results
+
+    def _match_face(self, face_encoding: np.ndarray, results: List[Dict]) -> Optional[Tuple[str, float]]:
+        """Pick the best cached candidate for a face, or None if matching failed."""
+        name = "Unknown"
+        confidence = 0.0
+
+        if self._arcface is not None:
+            # ArcFace embeddings are unit vectors, the cosine similarity is the confidence
+            if results:
+                name = results[0]["name"]
+                confidence = results[0]["similarity"]
+            return name, confidence
+
+        if results:
+            try:
+                candidate_encodings = [result["embedding"] for result in results]
+                candidate_names = [result["name"] for result in results]
+
+                # Compare with candidate faces using face_recognition
+                matches = face_recognition.compare_faces(candidate_encodings, face_encoding, tolerance=0.6)
+                face_distances = face_recognition.face_distance(candidate_encodings, face_encoding)
+
+                if len(face_distances) > 0:
+                    best_match_index = np.argmin(face_distances)
+                    if matches[best_match_index]:
+                        name = candidate_names[best_match_index]
+                        confidence = 1 - face_distances[best_match_index]
+                        # Also consider the vector similarity as a factor
+                        vector_confidence = results[best_match_index]["similarity"]
+                        # Take the average of both confidence measures
+                        confidence = (confidence + vector_confidence) / 2
+            except Exception as e:
+                print(f"Error processing embeddings: {e}")
+                return None
+
+        return name, confidence
\ No newline at end of file
@@ -1,14 +1,20 @@
 import psycopg2
 import numpy as np
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 from psycopg2.extras import execute_values
 from fastapi import FastAPI, UploadFile, File
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from .face_processor import FaceProcessor
+from .face_processor import EMBEDDING_DIMS, FaceProcessor
 from .face_vector import FaceEmbeddingDB
+from .video_reader import MotionGate, VideoFrameSampler
 import cv2
-import tempfile
 import os
+import json
+import itertools
+import asyncio
+import aiofiles
 import face_recognition
 import math
 
@@ -20,6 +26,26 @@ GEOFENCES = {
 # Maximum allowed distance in meters to be considered within the geofence
 MAX_DISTANCE = 100
 
+# Up to this many geofences are checked in-process; larger sets are left to PostGIS
+GEOFENCE_DB_THRESHOLD = 256
+
+# Geofence coordinates in radians as an (M, 2) array of (latitude, longitude)
+_FENCE_RAD = np.radians(np.array(list(GEOFENCES.values()), dtype=np.float64).reshape(-1, 2))
+
+# Number of sampled video frames run through face detection together
+FRAME_BATCH_SIZE = 32
+
+# Only every 5th frame is decoded (grab() skips the rest on the OpenCV path) and then
+# motion-gated, so detection never runs on more frames than a fixed stride of 5 would
+VIDEO_SAMPLE_STRIDE = 5
+
+# Face model: "dlib" (CPU/CUDA dlib, 128-d) or "arcface" (insightface on TensorRT/CUDA, 512-d).
+# Switching models changes the embedding size, so existing users must be re-enrolled.
+FACE_MODEL = "dlib"
+
+# Uploads are streamed to disk in chunks of this size
+UPLOAD_CHUNK_SIZE = 1 << 20
+
 app = FastAPI()
 
 # CORS configuration
@@ -40,20 +66,33 @@ db_params = {
 }
 
 # Initialize database handler
-db_handler = FaceEmbeddingDB(db_params)
+db_handler = FaceEmbeddingDB(db_params, embedding_dim=EMBEDDING_DIMS[FACE_MODEL])
+
+# Keep the PostGIS geofence table in sync with the configured locations
+db_handler.sync_geofences(GEOFENCES)
 
 # Initialize face processor
-face_processor = FaceProcessor("./employee_images", db_handler)
-
-def haversine(lat1, lon1, lat2, lon2):
-    """Calculate the Haversine distance between two points."""
-    R = 6371  # Radius of the Earth in kilometers
-    dlat = math.radians(lat2 - lat1)
-    dlon = math.radians(lon2 - lon1)
-    a = math.sin(dlat / 2) * math.sin(dlat / 2) + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon / 2) * math.sin(dlon / 2)
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    distance = R * c * 1000  # Convert to meters
-    return distance
+face_processor = FaceProcessor("./employee_images", db_handler, model=FACE_MODEL)
+
+def within_any_geofence(latitude: float, longitude: float, max_distance: float) -> bool:
+    """Check the Haversine distance to every geofence at once."""
+    lat, lon = math.radians(latitude), math.radians(longitude)
+    dlat = _FENCE_RAD[:, 0] - lat
+    dlon = _FENCE_RAD[:, 1] - lon
+    a = np.sin(dlat / 2) ** 2 + math.cos(lat) * np.cos(_FENCE_RAD[:, 0]) * np.sin(dlon / 2) ** 2
+    distances = 2 * 6371000 * np.arcsin(np.sqrt(np.minimum(a, 1.0)))  # Radius of the Earth in meters
+    return bool(distances.size) and bool(distances.min() <= max_distance)
+
+async def is_within_geofence(latitude: float, longitude: float) -> bool:
+    """Check whether a location is within MAX_DISTANCE of any geofence."""
+    if len(GEOFENCES) <= GEOFENCE_DB_THRESHOLD:
+        return within_any_geofence(latitude, longitude, MAX_DISTANCE)
+    return await asyncio.to_thread(db_handler.is_within_any_geofence, latitude, longitude, MAX_DISTANCE)
+
+async def save_upload(upload: UploadFile, f) -> None:
+    """Stream an uploaded file into an open aiofiles handle chunk by chunk."""
+    while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+        await f.write(chunk)
 
 @app.post("/enroll-photo/")
 async def enroll_photo(name: str, photo: UploadFile = File(...)):
@@ -86,72 +125,78 @@ async def enroll_photo(name: str, photo: UploadFile = File(...)):
         photo_path = os.path.join(employee_dir, f"{name}.jpg")
 
         # Save the uploaded photo to the specified path
-        with open(photo_path, "wb") as f:
-            content = await photo.read()
-            f.write(content)
+        async with aiofiles.open(photo_path, "wb") as f:
+            await save_upload(photo, f)
 
         # Generate embedding
-        encoding = face_processor._process_employee_image(photo_path, name)
+        encoding = await asyncio.to_thread(face_processor.encode_image, photo_path)
         if encoding is None:
             return {"status_code": 400, "message": "Failed to generate embedding."}
 
-        # Check if a similar embedding already exists
-        similar_embeddings = db_handler.vector_search(encoding)
-        if similar_embeddings:
+        # Store the embedding unless the name or a similar face is already enrolled
+        duplicate_distance = 1 - face_processor.similarity_threshold
+        user_id, conflict = await asyncio.to_thread(db_handler.store_if_unique, name, encoding, duplicate_distance)
+        if conflict == "name":
+            return {"status_code": 400, "message": f"User '{name}' already exists."}
+        if conflict == "face":
             return {"status_code": 400, "message": f"User with similar face already exists."}
 
-        # Store the embedding in the database
-        if db_handler.store_embedding(name, encoding):
-            return {"message": f"Embedding stored successfully for {name}."}
-        else:
-            return {"status_code": 400, "message": "Failed to store embedding."}
+        return {"message": f"Embedding stored successfully for {name}."}
 
     except Exception as e:
         return {"status_code": 500, "message": f"Error: {str(e)}"}
 
 
 
+def detect_frames(batch: List[Tuple[int, np.ndarray]]) -> List[Dict]:
+    """Run face detection on a batch of (frame index, frame) pairs."""
+    batch_detected_faces = face_processor.process_video_frames_batched([frame for _, frame in batch])
+    return [
+        {"frame": frame_count, "detected_faces": detected_faces}
+        for (frame_count, _), detected_faces in zip(batch, batch_detected_faces)
+        if detected_faces
+    ]
+
+def detect_video(video_path: str) -> Dict:
+    """Detect faces in every sampled frame of a video file."""
+    results = []
+    # Decodes on the GPU (NVDEC) when available
+    sampler = VideoFrameSampler(video_path, stride=VIDEO_SAMPLE_STRIDE)
+    # Only frames with visible motion, or 30 frames after the last one checked, reach the face model
+    motion_gate = MotionGate(threshold=5.0, max_gap=30)
+
+    batch = []
+    for frame_count, frame in sampler:
+        if not motion_gate(frame_count, frame):
+            continue
+        batch.append((frame_count, frame))
+        if len(batch) == FRAME_BATCH_SIZE:
+            results.extend(detect_frames(batch))
+            batch = []
+    if batch:
+        results.extend(detect_frames(batch))
+
+    return {
+        "total_frames": sampler.total_frames,
+        "processed_frames": len(results),
+        "detections": results
+    }
+
 @app.post("/process-video")
 async def process_video(video: UploadFile = File(...)):
     """Process uploaded video and detect faces."""
     # Save uploaded video to temporary file
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.mp4') as temp_video:
-        content = await video.read()
-        temp_video.write(content)
+    async with aiofiles.tempfile.NamedTemporaryFile(delete=False, suffix='.mp4') as temp_video:
+        await save_upload(video, temp_video)
         temp_video_path = temp_video.name
 
     try:
-        results = []
-        cap = cv2.VideoCapture(temp_video_path)
-        frame_count = 0
-
-        while cap.isOpened():
-            ret, frame = cap.read()
-            if not ret:
-                break
-
-            # Process every 5th frame to improve performance
-            if frame_count % 5 == 0:
-                detected_faces = face_processor.process_video_frame(frame)
-                if detected_faces:
-                    results.append({
-                        "frame": frame_count,
-                        "detected_faces": detected_faces
-                    })
-
-            frame_count += 1
-
-        cap.release()
-
-        return {
-            "total_frames": frame_count,
-            "processed_frames": len(results),
-            "detections": results
-        }
+        # Decoding and detection run in a worker thread to keep the event loop free
+        return await asyncio.to_thread(detect_video, temp_video_path)
 
     finally:
         # Cleanup temporary file
-        os.unlink(temp_video_path)
+        await asyncio.to_thread(os.unlink, temp_video_path)
 
 
 @app.post("/process-checkin")
@@ -159,35 +204,30 @@ async def process_checkin(photo: UploadFile = File(...), latitude: float = 16.54
     """Process check-in photo and detect faces with geofencing."""
     try:
         # Check if the user is within any geofence
-        user_location = (latitude, longitude)
-        is_within_geofence = any(
-            haversine(user_location[0], user_location[1], geofence[0], geofence[1]) <= MAX_DISTANCE
-            for geofence in GEOFENCES.values()
-        )
-
-        if not is_within_geofence:
+        if not await is_within_geofence(latitude, longitude):
             return {"success": False, "message": "Check-in failed. You are not within the allowed area."}
 
-        # Save the uploaded photo to a temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as temp_photo:
-            content = await photo.read()
-            temp_photo.write(content)
-            temp_photo_path = temp_photo.name
+        # Decode the photo straight from the uploaded bytes
+        content = await photo.read()
+        frame = await asyncio.to_thread(cv2.imdecode, np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_COLOR)
 
         # Process the photo to detect faces
-        detected_faces = face_processor.process_video_frame(cv2.imread(temp_photo_path))
-
-        # Cleanup temporary file
-        os.unlink(temp_photo_path)
+        detected_faces = await asyncio.to_thread(face_processor.process_video_frame, frame)
 
         if detected_faces and detected_faces[0]['name'] != 'Unknown':
             user_name = detected_faces[0]['name']
 
             # Check if the user has already checked in today
-            if db_handler.has_checked_in_today(user_name):
+            if await asyncio.to_thread(db_handler.has_checked_in_today, user_name):
                 return {"success": False, "message": "You have already checked in today."}
 
-            db_handler.log_attendance(user_name, 'checkin', latitude, longitude)
+            # The check is repeated and the insert made in one transaction, so two
+            # concurrent requests for the same face can't both log the event
+            logged = await asyncio.to_thread(db_handler.log_attendance_once, user_name, 'checkin', latitude, longitude)
+            if logged is None:
+                return {"success": False, "message": "Check-in could not be recorded. Please try again."}
+            if not logged:
+                return {"success": False, "message": "You have already checked in today."}
             return {"success": True, "message": "Check-in successful!"}
         else:
             return {"success": False, "message": "Face not recognized."}
@@ -200,35 +240,30 @@ async def process_checkout(photo: UploadFile = File(...), latitude: float = 16.5
     """Process check-out photo and detect faces with geofencing."""
     try:
         # Check if the user is within any geofence
-        user_location = (latitude, longitude)
-        is_within_geofence = any(
-            haversine(user_location[0], user_location[1], geofence[0], geofence[1]) <= MAX_DISTANCE
-            for geofence in GEOFENCES.values()
-        )
-
-        if not is_within_geofence:
+        if not await is_within_geofence(latitude, longitude):
             return {"success": False, "message": "Check-out failed. You are not within the allowed area."}
 
-        # Save the uploaded photo to a temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as temp_photo:
-            content = await photo.read()
-            temp_photo.write(content)
-            temp_photo_path = temp_photo.name
+        # Decode the photo straight from the uploaded bytes
+        content = await photo.read()
+        frame = await asyncio.to_thread(cv2.imdecode, np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_COLOR)
 
         # Process the photo to detect faces
-        detected_faces = face_processor.process_video_frame(cv2.imread(temp_photo_path))
-
-        # Cleanup temporary file
-        os.unlink(temp_photo_path)
+        detected_faces = await asyncio.to_thread(face_processor.process_video_frame, frame)
 
         if detected_faces and detected_faces[0]['name'] != 'Unknown':
             user_name = detected_faces[0]['name']
 
             # Check if the user has already checked out today
-            if db_handler.has_checked_out_today(user_name):
+            if await asyncio.to_thread(db_handler.has_checked_out_today, user_name):
                 return {"success": False, "message": "You have already checked out today."}
 
-            db_handler.log_attendance(user_name, 'checkout', latitude, longitude)
+            # The check is repeated and the insert made in one transaction, so two
+            # concurrent requests for the same face can't both log the event
+            logged = await asyncio.to_thread(db_handler.log_attendance_once, user_name, 'checkout', latitude, longitude)
+            if logged is None:
+                return {"success": False, "message": "Check-out could not be recorded. Please try again."}
+            if not logged:
+                return {"success": False, "message": "You have already checked out today."}
             return {"success": True, "message": "Check-out successful!"}
         else:
             return {"success": False, "message": "Face not recognized."}
@@ -242,17 +277,23 @@ async def root():
     return {"message": "Face Recognition API is running"}
 
 @app.get("/getall")
-async def find():
-    results = db_handler.retrieve_all_data()
-    return results
+def find():
+    # One JSON object per line, streamed page by page from the database.
+    # The first row is fetched here so a failing query still returns a 500;
+    # later errors abort the stream rather than truncating it silently.
+    data = db_handler.retrieve_all_data()
+    first = next(data, None)
+    rows = itertools.chain([first], data) if first is not None else iter(())
+    lines = (json.dumps(jsonable_encoder(row)) + "\n" for row in rows)
+    return StreamingResponse(lines, media_type="application/x-ndjson")
 
 @app.get("/delete")
-async def delete():
+def delete():
     db_handler.delete_tables()
     return {"message": "Tables deleted"}
 
 @app.delete("/delete-user/{name}")
-async def delete_user(name: str):
+def delete_user(name: str):
     try:
         success = db_handler.delete_user(name)
         if success:
@@ -263,13 +304,13 @@ async def delete_user(name: str):
         return {"status": "error", "message": f"Error deleting user: {str(e)}"}
 
 @app.get("/attendance/{user_name}")
-async def get_attendance(user_name: str):
+def get_attendance(user_name: str):
     """Fetch attendance records for a specific user."""
     attendance_records = db_handler.retrieve_attendance(user_name)
     return attendance_records
 
 @app.get("/user-report/{user_name}")
-async def get_user_report(user_name: str):
+def get_user_report(user_name: str):
     """
     Get detailed attendance report for a specific user.
 
@@ -1,2 +1,5 @@
 -- Enable pgvector extension
 CREATE EXTENSION IF NOT EXISTS vector;
+
+-- Enable PostGIS for geofence lookups
+CREATE EXTENSION IF NOT EXISTS postgis;